@@ -1,3 +1,4 @@
+import argparse
 import calendar
 import os
 from collections import defaultdict
@@ -5,34 +6,41 @@ from datetime import datetime
 
 import matplotlib
 import matplotlib.pyplot as plt
-import numpy as np
 from matplotlib.colors import LinearSegmentedColormap
 from pymongo import MongoClient
 
-
-matplotlib.use('agg')
-SIGNIFICANT_PRICE_DIFFERENCE = 50
+from bootstrap import bootstrap_breakdown, export_intervals, \
+    significance_shades
+from cache import breakdown_fingerprint, collection_fingerprint, is_cached, \
+    store_summary, summarize
+from sampling import export_preview, preview_bounds, sample_breakdown
+from utils import AGE_GROUPS, CAR_AGE_GROUPS
 
 
-def main():
-    # MongoDB connection
-    client = MongoClient("mongodb://localhost:27017")
-    db = client["insurance_db"]
-    collection = db["insurance_collection"]
-    cmap = LinearSegmentedColormap.from_list('custom',
-                                             ['green', 'white', 'red'])
-
-    # Overall analysis
-    pipeline = [
-        {
-            "$unwind": "$prices"
-        },
-        {
-            "$group": {
-                "_id": "$prices.brandCode",
-                "prices": {"$push": "$prices.totalAmount"},
-            }
-        },
+matplotlib.use('agg')
+FIGURES_PATH = './figures'
+LOCATIONS = ['ZG', 'ST', 'RI', 'DU']
+
+
+def price_stats_stages(fields):
+    # Shared tail of every breakdown: sorted prices and summary statistics
+    # per insurer and bucket fields
+    project = {"_id": 0, "insurer": "$_id.insurer"}
+    for field in fields:
+        project[field] = f"$_id.{field}"
+    project.update({
+        "avg": 1,
+        "minPrice": 1,
+        "maxPrice": 1,
+        "percentile25": {"$arrayElemAt": ["$prices", {
+            "$ceil": {"$multiply": [0.25, "$count"]}}]},
+        "median": {"$arrayElemAt": ["$prices", {
+            "$ceil": {"$multiply": [0.5, "$count"]}}]},
+        "percentile75": {"$arrayElemAt": ["$prices", {
+            "$ceil": {"$multiply": [0.75, "$count"]}}]},
+        "prices": 1,
+    })
+    return [
         {"$unwind": "$prices"},
         {"$sort": {"prices": 1}},
         {
@@ -45,52 +53,26 @@ def main():
                 "count": {"$sum": 1}
             }
         },
-        {
-            "$project": {
-                "_id": 1,
-                "avg": 1,
-                "minPrice": 1,
-                "maxPrice": 1,
-                "percentile25": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.25, "$count"]}}]},
-                "median": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.5, "$count"]}}]},
-                "percentile75": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.75, "$count"]}}]},
-                "prices": 1,
-            }
-        },
+        {"$project": project},
     ]
 
-    results = list(collection.aggregate(pipeline))
-
-    results.sort(key=lambda x: x['_id'])
-    insurers = [result['_id'] for result in results]
-    prices = [result['prices'] for result in results]
-
-    median_all = np.median(np.concatenate(prices))
-    diff = [(np.median(prices_insurer) -
-             median_all) / SIGNIFICANT_PRICE_DIFFERENCE + 0.5
-            for prices_insurer in prices]
-
-    fig, ax = plt.subplots()
-    boxplots = ax.boxplot(prices, patch_artist=True, showfliers=False)
 
-    for patch, color in zip(boxplots['boxes'], cmap(diff)):
-        patch.set_facecolor(color)
-
-    ax.set_xticklabels(insurers)
-    ax.set_ylabel('Price')
-    ax.set_title('Insurance Prices by Insurer')
-    ax.tick_params(axis='x', rotation=20)
-
-    folder_path = './figures'
+def insurers_pipeline():
+    return [
+        {
+            "$unwind": "$prices"
+        },
+        {
+            "$group": {
+                "_id": {"insurer": "$prices.brandCode"},
+                "prices": {"$push": "$prices.totalAmount"},
+            }
+        },
+    ] + price_stats_stages([])
 
-    file_path = os.path.join(folder_path, 'insurers_prices_boxplot.png')
-    plt.savefig(file_path)
 
-    # Age breakdown
-    pipeline_age = [
+def age_pipeline():
+    return [
         {
             "$unwind": "$prices"
         },
@@ -100,7 +82,7 @@ def main():
                     "insurer": "$prices.brandCode",
                     "age": {
                         "$subtract": [
-                            {"$year": datetime.now()},
+                            datetime.now().year,
                             {"$year": {"$dateFromString": {
                                 "dateString":
                                     "$calculationData.data.owner.birthDate"}}}
@@ -110,93 +92,13 @@ def main():
                 "prices": {"$push": "$prices.totalAmount"},
             }
         },
-        {"$unwind": "$prices"},
-        {"$sort": {"prices": 1}},
-        {
-            "$group": {
-                "_id": "$_id",
-                "avg": {"$avg": "$prices"},
-                "minPrice": {"$first": "$prices"},
-                "maxPrice": {"$last": "$prices"},
-                "prices": {"$push": "$prices"},
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "insurer": "$_id.insurer",
-                "age": "$_id.age",
-                "avg": 1,
-                "minPrice": 1,
-                "maxPrice": 1,
-                "percentile25": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.25, "$count"]}}]},
-                "median": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.5, "$count"]}}]},
-                "percentile75": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.75, "$count"]}}]},
-                "prices": 1,
-            }
-        },
-    ]
-
-    results_age = list(collection.aggregate(pipeline_age))
-
-    # Grouping age categories
-    age_groups = {
-        '18-24': {'min': 0, 'max': 24},
-        '25-65': {'min': 25, 'max': 65},
-        '65+': {'min': 66, 'max': float('inf')}
-    }
-
-    # Grouping prices by age category and insurer
-    grouped_prices = {group: {result['insurer']: [] for result in results_age}
-                      for group in age_groups}
-
-    for result in results_age:
-        for group, age_range in age_groups.items():
-            if age_range['min'] <= result['age'] <= age_range['max']:
-                grouped_prices[group][result['insurer']].extend(
-                    result['prices'])
-                break
-
-    fig, axes = plt.subplots(nrows=len(age_groups), ncols=1, figsize=(10, 8))
+    ] + price_stats_stages(["age"])
 
-    for idx, (group, prices_by_insurer) in enumerate(grouped_prices.items()):
-        ax = axes[idx]
-        insurers_sorted = sorted(prices_by_insurer.keys())
-
-        median_all = np.median(np.concatenate([prices_by_insurer[insurer]
-                                               for insurer in
-                                               prices_by_insurer]))
-        diff = [(np.median(prices_by_insurer[insurer]) -
-                 median_all) / SIGNIFICANT_PRICE_DIFFERENCE + 0.5
-                for insurer in insurers_sorted]
 
-        boxplots = ax.boxplot([prices_by_insurer[insurer]
-                               for insurer in insurers_sorted],
-                              patch_artist=True, showfliers=False)
-        for patch, color in zip(boxplots['boxes'], cmap(diff)):
-            patch.set_facecolor(color)
-
-        ax.set_xticklabels(insurers_sorted)
-        ax.set_ylabel('Price')
-        ax.set_xlabel('Insurer')
-        ax.set_title(f'Insurance Prices by Insurer - Age Group: {group}')
-
-    fig.tight_layout()
-
-    folder_path = './figures'
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-
-    file_path = os.path.join(folder_path,
-                             'insurance_prices_age_insurer_boxplot.png')
-    plt.savefig(file_path)
-
-    # Car age breakdown
-    pipeline_car_age = [
+def car_age_pipeline():
+    branches = [{"case": {"$lt": ["$$carAge", limit]}, "then": group}
+                for limit, group in CAR_AGE_GROUPS]
+    return [
         {
             "$unwind": "$prices"
         },
@@ -207,7 +109,7 @@ def main():
                         "vars": {
                             "carAge": {
                                 "$subtract": [
-                                    {"$year": datetime.now()},
+                                    datetime.now().year,
                                     {
                                         "$toInt":
                                 "$calculationData.data.vehicle.productionYear"},
@@ -216,18 +118,7 @@ def main():
                         },
                         "in": {
                             "$switch": {
-                                "branches": [
-                                    {"case": {"$lt": ["$$carAge", 5]},
-                                     "then": "Below 5 years"},
-                                    {"case": {"$lt": ["$$carAge", 10]},
-                                     "then": "5 to 10 years"},
-                                    {"case": {"$lt": ["$$carAge", 15]},
-                                     "then": "10 to 15 years"},
-                                    {"case": {"$lt": ["$$carAge", 20]},
-                                     "then": "15 to 20 years"},
-                                    {"case": {"$lt": ["$$carAge", 25]},
-                                     "then": "20 to 25 years"}
-                                ],
+                                "branches": branches,
                                 "default": "Above 25 years"
                             }
                         }
@@ -244,88 +135,11 @@ def main():
                 "prices": {"$push": "$prices.totalAmount"},
             }
         },
-        {"$unwind": "$prices"},
-        {"$sort": {"prices": 1}},
-        {
-            "$group": {
-                "_id": "$_id",
-                "avg": {"$avg": "$prices"},
-                "minPrice": {"$first": "$prices"},
-                "maxPrice": {"$last": "$prices"},
-                "prices": {"$push": "$prices"},
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "insurer": "$_id.insurer",
-                "carAgeGroup": "$_id.carAgeGroup",
-                "avg": 1,
-                "minPrice": 1,
-                "maxPrice": 1,
-                "percentile25": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.25, "$count"]}}]},
-                "median": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.5, "$count"]}}]},
-                "percentile75": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.75, "$count"]}}]},
-                "prices": 1,
-            }
-        },
-    ]
-
-    results_car_age = list(collection.aggregate(pipeline_car_age))
-
-    grouped_prices = defaultdict(lambda: {})
-    for result in results_car_age:
-        grouped_prices[result['carAgeGroup']][result['insurer']] = result[
-            'prices']
-
-    # Creating subplots for each car age category
-    fig, axes = plt.subplots(nrows=len(grouped_prices), ncols=1,
-                             figsize=(10, 20),
-                             sharey=True)
-
-    for idx, group in enumerate(['Below 5 years', '5 to 10 years',
-                                 '10 to 15 years', '15 to 20 years',
-                                 '20 to 25 years']):
-        prices_by_insurer = grouped_prices[group]
-        ax = axes[idx]
-        insurers_sorted = sorted(prices_by_insurer.keys())
-
-        median_all = np.median([np.median(prices_by_insurer[insurer])
-                                for insurer in insurers_sorted])
-        diff = [(np.median(prices_by_insurer[insurer]) -
-                 median_all)/SIGNIFICANT_PRICE_DIFFERENCE + 0.5
-                for insurer in insurers_sorted]
-
-        boxplots = ax.boxplot([prices_by_insurer[insurer]
-                               for insurer in insurers_sorted],
-                              patch_artist=True, showfliers=False)
-
-        for patch, color in zip(boxplots['boxes'], diff):
-            patch.set_facecolor(cmap(color))
-
-        ax.set_xticklabels(insurers_sorted)
-        ax.set_ylabel('Price')
-        ax.set_xlabel('Insurer')
-        ax.set_title(f'Insurance Prices by Insurer - Car Age Group: {group}')
-
-    # Adjusting the spacing between subplots
-    fig.tight_layout()
+    ] + price_stats_stages(["carAgeGroup"])
 
-    # Save the figure to a file
-    folder_path = './figures'
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
 
-    file_path = os.path.join(folder_path,
-                             'insurance_prices_car_age_insurer_boxplot.png')
-    plt.savefig(file_path)
-
-    # Location breakdown
-    pipeline_location = [
+def location_pipeline():
+    return [
         {
             "$unwind": "$prices"
         },
@@ -338,83 +152,11 @@ def main():
                 "prices": {"$push": "$prices.totalAmount"},
             }
         },
-        {"$unwind": "$prices"},
-        {"$sort": {"prices": 1}},
-        {
-            "$group": {
-                "_id": "$_id",
-                "avg": {"$avg": "$prices"},
-                "minPrice": {"$first": "$prices"},
-                "maxPrice": {"$last": "$prices"},
-                "prices": {"$push": "$prices"},
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "insurer": "$_id.insurer",
-                "location": "$_id.location",
-                "avg": 1,
-                "minPrice": 1,
-                "maxPrice": 1,
-                "percentile25": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.25, "$count"]}}]},
-                "median": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.5, "$count"]}}]},
-                "percentile75": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.75, "$count"]}}]},
-                "prices": 1,
-            }
-        },
-    ]
-
-    results_location = list(collection.aggregate(pipeline_location))
-
-    grouped_prices = defaultdict(lambda: {})
-    for result in results_location:
-        grouped_prices[result['location']][result['insurer']] = result['prices']
-
-    # Creating subplots for each location
-    fig, axes = plt.subplots(nrows=len(grouped_prices), ncols=1,
-                             figsize=(10, 20))
-
-    for idx, location in enumerate(['ZG', 'ST', 'RI', 'DU']):
-        prices_by_insurer = grouped_prices[location]
-        ax = axes[idx]
-        insurers_sorted = sorted(prices_by_insurer.keys())
-        median_all = np.median([np.median(prices_by_insurer[insurer])
-                                for insurer in insurers_sorted])
-        diff = [(np.median(prices_by_insurer[insurer]) -
-                 median_all)/SIGNIFICANT_PRICE_DIFFERENCE + 0.5
-                for insurer in insurers_sorted]
-
-        boxplots = ax.boxplot([prices_by_insurer[insurer]
-                               for insurer in insurers_sorted],
-                              patch_artist=True, showfliers=False)
-
-        for patch, color in zip(boxplots['boxes'], diff):
-            patch.set_facecolor(cmap(color))
-
-        ax.set_xticklabels(insurers_sorted)
-        ax.set_ylabel('Price')
-        ax.set_xlabel('Insurer')
-        ax.set_title(f'Insurance Prices by Insurer - Location: {location}')
+    ] + price_stats_stages(["location"])
 
-    # Adjusting the spacing between subplots
-    fig.tight_layout()
 
-    # Save the figure to a file
-    folder_path = './figures'
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-
-    file_path = os.path.join(folder_path,
-                             'insurance_prices_location_insurer_boxplot.png')
-    plt.savefig(file_path)
-
-    # Seasonality breakdown analysis
-    pipeline_seasonality = [
+def seasonality_pipeline():
+    return [
         {
             "$unwind": "$prices"
         },
@@ -434,81 +176,297 @@ def main():
                 "prices": {"$push": "$price"},
             }
         },
-        {"$unwind": "$prices"},
-        {"$sort": {"prices": 1}},
-        {
-            "$group": {
-                "_id": "$_id",
-                "avg": {"$avg": "$prices"},
-                "minPrice": {"$first": "$prices"},
-                "maxPrice": {"$last": "$prices"},
-                "prices": {"$push": "$prices"},
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "insurer": "$_id.insurer",
-                "month": "$_id.month",
-                "avg": 1,
-                "minPrice": 1,
-                "maxPrice": 1,
-                "percentile25": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.25, "$count"]}}]},
-                "median": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.5, "$count"]}}]},
-                "percentile75": {"$arrayElemAt": ["$prices", {
-                    "$ceil": {"$multiply": [0.75, "$count"]}}]},
-                "prices": 1,
-            }
-        },
-        {"$sort": {"insurer": 1, "month": 1}}
-    ]
+    ] + price_stats_stages(["month"])
 
-    results_seasonality = list(collection.aggregate(pipeline_seasonality))
 
-    grouped_prices = defaultdict(lambda: {})
-    for result in results_seasonality:
-        grouped_prices[result['month']][result['insurer']] = result['prices']
+def group_by_field(results, field, order):
+    grouped_prices = defaultdict(dict)
+    for result in results:
+        grouped_prices[result[field]][result['insurer']] = result['prices']
+    return {bucket: grouped_prices[bucket] for bucket in order
+            if bucket in grouped_prices}
 
-    months = list(grouped_prices.keys())
-    months_textual = [calendar.month_name[int(month)] for month in months]
 
-    fig, axes = plt.subplots(nrows=len(months), ncols=1, figsize=(15, 30))
-    for idx, month in enumerate(months):
-        ax = axes[idx]
-        insurers_sorted = sorted(grouped_prices[month].keys())
-        prices_month = [grouped_prices[month][insurer] for insurer in
-                        insurers_sorted]
+def group_insurers(results):
+    return {'All': {result['insurer']: result['prices']
+                    for result in results}}
 
-        median_all = np.median(np.concatenate(prices_month))
-        diff = [(np.median(prices) -
-                    median_all)/SIGNIFICANT_PRICE_DIFFERENCE + 0.5
-                    for prices in prices_month]
 
-        boxplot = ax.boxplot(prices_month, patch_artist=True,
-                             labels=insurers_sorted, showfliers=False)
+def group_age(results):
+    # Grouping prices by age category and insurer
+    grouped_prices = {group: defaultdict(list) for group in AGE_GROUPS}
+    for result in results:
+        for group, age_range in AGE_GROUPS.items():
+            if age_range['min'] <= result['age'] <= age_range['max']:
+                grouped_prices[group][result['insurer']].extend(
+                    result['prices'])
+                break
+    return {group: dict(prices_by_insurer)
+            for group, prices_by_insurer in grouped_prices.items()
+            if prices_by_insurer}
+
+
+def group_car_age(results):
+    order = [group for _, group in CAR_AGE_GROUPS] + ['Above 25 years']
+    return group_by_field(results, 'carAgeGroup', order)
+
+
+def group_location(results):
+    return group_by_field(results, 'location', LOCATIONS)
+
+
+def group_seasonality(results):
+    grouped_prices = group_by_field(results, 'month', range(1, 13))
+    return {calendar.month_name[month]: prices_by_insurer
+            for month, prices_by_insurer in grouped_prices.items()}
+
+
+# Strata of the preview mode: the $match filter selecting each bucket's
+# quotes, written as ranges on the stored fields of STRATA_INDEXES
+STRATA_INDEXES = [
+    "calculationData.data.owner.birthDate",
+    "calculationData.data.vehicle.productionYear",
+    "calculationData.data.registration.prefix",
+    "createdAt",
+]
+
+
+def insurers_strata(collection):
+    return [('All', {})]
+
+
+def age_strata(collection):
+    current_year = datetime.now().year
+    strata = []
+    for group, age_range in AGE_GROUPS.items():
+        birth_date = {"$lt": f"{current_year - age_range['min'] + 1}-01-01"}
+        if age_range['max'] != float('inf'):
+            birth_date["$gte"] = f"{current_year - age_range['max']}-01-01"
+        strata.append(
+            (group, {"calculationData.data.owner.birthDate": birth_date}))
+    return strata
+
+
+def car_age_strata(collection):
+    current_year = datetime.now().year
+    strata = []
+    lower = 0
+    for limit, group in CAR_AGE_GROUPS + [(None, 'Above 25 years')]:
+        production_year = {"$lte": str(current_year - lower)}
+        if limit is not None:
+            production_year["$gt"] = str(current_year - limit)
+            lower = limit
+        strata.append(
+            (group,
+             {"calculationData.data.vehicle.productionYear": production_year}))
+    return strata
+
+
+def location_strata(collection):
+    return [(location, {"calculationData.data.registration.prefix": location})
+            for location in LOCATIONS]
+
+
+def seasonality_strata(collection):
+    first = collection.find_one(sort=[("createdAt", 1)],
+                                projection={"createdAt": 1})
+    last = collection.find_one(sort=[("createdAt", -1)],
+                               projection={"createdAt": 1})
+    if first is None:
+        return []
+    years = range(int(first["createdAt"][:4]), int(last["createdAt"][:4]) + 1)
+    strata = []
+    for month in range(1, 13):
+        next_month = f"{month + 1:02d}" if month < 12 else "13"
+        strata.append((calendar.month_name[month], {"$or": [
+            {"createdAt": {"$gte": f"{year}-{month:02d}",
+                           "$lt": f"{year}-{next_month}"}}
+            for year in years]}))
+    return strata
+
+
+BREAKDOWNS = [
+    {
+        'name': 'insurers',
+        'pipeline': insurers_pipeline,
+        'strata': insurers_strata,
+        'group': group_insurers,
+        'title': 'Insurance Prices by Insurer',
+        'file_name': 'insurers_prices_boxplot.png',
+        'figsize': None,
+        'rotation': 20,
+    },
+    {
+        'name': 'age',
+        'pipeline': age_pipeline,
+        'strata': age_strata,
+        'group': group_age,
+        'title': 'Insurance Prices by Insurer - Age Group: {bucket}',
+        'file_name': 'insurance_prices_age_insurer_boxplot.png',
+        'figsize': (10, 8),
+    },
+    {
+        'name': 'car_age',
+        'pipeline': car_age_pipeline,
+        'strata': car_age_strata,
+        'group': group_car_age,
+        'title': 'Insurance Prices by Insurer - Car Age Group: {bucket}',
+        'file_name': 'insurance_prices_car_age_insurer_boxplot.png',
+        'figsize': (10, 20),
+    },
+    {
+        'name': 'location',
+        'pipeline': location_pipeline,
+        'strata': location_strata,
+        'group': group_location,
+        'title': 'Insurance Prices by Insurer - Location: {bucket}',
+        'file_name': 'insurance_prices_location_insurer_boxplot.png',
+        'figsize': (10, 20),
+    },
+    {
+        'name': 'seasonality',
+        'pipeline': seasonality_pipeline,
+        'strata': seasonality_strata,
+        'group': group_seasonality,
+        'title': 'Insurance Prices by Insurer - {bucket}',
+        'file_name': 'insurance_prices_seasonality_insurer_boxplot.png',
+        'figsize': (15, 30),
+    },
+]
+
+
+def fetch_breakdown(collection, breakdown):
+    results = list(collection.aggregate(breakdown['pipeline']()))
+    return breakdown['group'](results)
+
+
+def plot_breakdown(breakdown, grouped_prices, shades, cmap,
+                   folder_path=FIGURES_PATH):
+    fig, axes = plt.subplots(nrows=len(grouped_prices), ncols=1,
+                             figsize=breakdown['figsize'], squeeze=False)
 
-        for patch, color in zip(boxplot['boxes'], diff):
-            patch.set_facecolor(cmap(color))
+    for ax, (bucket, prices_by_insurer) in zip(axes[:, 0],
+                                               grouped_prices.items()):
+        insurers_sorted = sorted(prices_by_insurer.keys())
+        boxplots = ax.boxplot([prices_by_insurer[insurer]
+                               for insurer in insurers_sorted],
+                              patch_artist=True, showfliers=False)
 
-        ax.set_xlabel('Insurer')
+        for patch, insurer in zip(boxplots['boxes'], insurers_sorted):
+            patch.set_facecolor(cmap(shades[bucket][insurer]))
+
+        ax.set_xticklabels(insurers_sorted)
         ax.set_ylabel('Price')
-        ax.set_title(f'Insurance Prices by Insurer - {months_textual[idx]}')
+        ax.set_xlabel('Insurer')
+        ax.set_title(breakdown['title'].format(bucket=bucket))
+        ax.tick_params(axis='x', rotation=breakdown.get('rotation', 0))
 
-    # Adjust the spacing between subplots
+    # Adjusting the spacing between subplots
     fig.tight_layout()
 
     # Save the figure to a file
-    folder_path = './figures'
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
-    file_path = os.path.join(folder_path,
-                             'insurance_prices_seasonality_insurer_boxplot.png')
+    file_path = os.path.join(folder_path, breakdown['file_name'])
     plt.savefig(file_path)
+    plt.close(fig)
+
+
+def preview(collection, args, cmap):
+    # Approximate figures from a stratified sample, kept apart from the exact
+    # ones and never cached
+    folder_path = os.path.join(FIGURES_PATH, 'preview')
+    # Without them every bucket draw is a collection scan
+    for field in STRATA_INDEXES:
+        collection.create_index(field)
+    for breakdown in BREAKDOWNS:
+        grouped_prices, stratum_sizes = sample_breakdown(
+            collection, breakdown['strata'](collection), args.sample)
+        intervals = bootstrap_breakdown(grouped_prices,
+                                        n_resamples=args.resamples,
+                                        confidence=args.confidence,
+                                        seed=args.seed,
+                                        processes=args.processes,
+                                        weights=stratum_sizes)
+        plot_breakdown(breakdown, grouped_prices,
+                       significance_shades(intervals), cmap, folder_path)
+        export_preview(preview_bounds(grouped_prices, args.confidence),
+                       os.path.join(folder_path,
+                                    f"{breakdown['name']}_preview.csv"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Analyze insurance prices per insurer and breakdown.')
+    parser.add_argument('--resamples', type=int, default=1000,
+                        help='Bootstrap replicates per bucket.')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the bootstrap intervals.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Processes used for bootstrapping.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true',
+                        help='Recompute breakdowns even if the collection '
+                             'did not change since the last run. Needed '
+                             'after quotes were updated in place, which the '
+                             'collection fingerprint does not detect.')
+    parser.add_argument('--sample', type=int, default=None,
+                        help='Preview mode: analyze at most this many '
+                             'sampled prices per insurer and bucket.')
+    args = parser.parse_args()
+    if args.resamples <= 0:
+        parser.error('--resamples must be a positive number of replicates')
+    if not 0 < args.confidence < 1:
+        parser.error('--confidence must be between 0 and 1')
+    if args.sample is not None and args.sample <= 0:
+        parser.error('--sample must be a positive number of prices')
+
+    # MongoDB connection
+    client = MongoClient("mongodb://localhost:27017")
+    db = client["insurance_db"]
+    collection = db["insurance_collection"]
+    # Insurers whose median is significantly below the market median are
+    # green, significantly above red and indistinguishable from it white
+    cmap = LinearSegmentedColormap.from_list('custom',
+                                             ['green', 'white', 'red'])
+
+    if args.sample is not None:
+        preview(collection, args, cmap)
+        client.close()
+        return
+
+    collection_key = collection_fingerprint(collection)
+    # Replicates are split into one seeded slice per process, so the
+    # intervals depend on the number of processes as well
+    params = {'resamples': args.resamples, 'confidence': args.confidence,
+              'seed': args.seed, 'processes': args.processes}
+
+    for breakdown in BREAKDOWNS:
+        fingerprint = breakdown_fingerprint(breakdown, collection_key, params)
+        figure_path = os.path.join(FIGURES_PATH, breakdown['file_name'])
+        intervals_path = os.path.join(FIGURES_PATH,
+                                      f"{breakdown['name']}_bootstrap.csv")
+        if not args.force and is_cached(FIGURES_PATH, breakdown, fingerprint,
+                                        [figure_path, intervals_path]):
+            print(f"Skipping {breakdown['name']} breakdown, "
+                  f"collection unchanged.")
+            continue
+
+        grouped_prices = fetch_breakdown(collection, breakdown)
+        intervals = bootstrap_breakdown(grouped_prices,
+                                        n_resamples=args.resamples,
+                                        confidence=args.confidence,
+                                        seed=args.seed,
+                                        processes=args.processes)
+        plot_breakdown(breakdown, grouped_prices,
+                       significance_shades(intervals), cmap)
+        export_intervals(intervals, intervals_path)
+        store_summary(FIGURES_PATH, breakdown, fingerprint,
+                      summarize(grouped_prices, intervals))
+
+    client.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
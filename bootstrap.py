@@ -0,0 +1,241 @@
+import csv
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Upper bound on the number of per replicate values held in memory at once
+MAX_ELEMENTS = 2 ** 22
+
+
+def _split(rng, counts, lo, hi, below, columns):
+    # One level of the binary descent: counts of the resampled prices of
+    # every insurer in [lo, hi) falling into the lower half, given the
+    # counts in the whole interval
+    mid = (lo + hi) // 2
+    size = below[columns, hi] - below[columns, lo]
+    lower = below[columns, mid] - below[columns, lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(size > 0, lower / size, 0.0)
+    return mid, rng.binomial(counts, p)
+
+
+def price_weights(prices_by_insurer, weights=None):
+    # Weight of a single price of every insurer in the market median, so
+    # that each insurer counts with its stratum size when its prices were
+    # capped by sampling. Without weights every price counts once.
+    insurers = sorted(prices_by_insurer)
+    if weights is None:
+        return np.ones(len(insurers))
+    return np.array([weights[insurer] / len(prices_by_insurer[insurer])
+                     for insurer in insurers], dtype=float)
+
+
+def weighted_median(values, weights):
+    # Lower weighted median: the smallest value reaching half of the weight
+    order = np.argsort(values, kind='stable')
+    cumulative = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+
+
+def resample_medians(prices_by_insurer, n_resamples, seed=None,
+                     max_elements=MAX_ELEMENTS, weights=None):
+    # Stratified bootstrap: every replicate resamples each insurer's prices
+    # on its own and the market median is taken over the union of those
+    # resamples, so the insurer and market medians of a replicate are paired.
+    #
+    # A resample is a multinomial draw of counts over the sorted pooled
+    # prices. Instead of drawing an index per price, the counts are revealed
+    # lazily by binary splitting: a node of the descent holds the counts per
+    # insurer in a range of pooled positions, and its lower half receives a
+    # binomial share of them. The market and every insurer descend towards
+    # their median rank, using the same draw whenever they sit on the same
+    # node, which keeps them consistent with a single resample at a cost of
+    # O(insurers * log(prices)) per replicate. Replicate medians are the
+    # lower median, ceil(n / 2)-th of the n resampled prices, and the market
+    # one is weighted by price_weights.
+    insurers = sorted(prices_by_insurer)
+    samples = [np.asarray(prices_by_insurer[insurer], dtype=float)
+               for insurer in insurers]
+    sizes = np.array([sample.size for sample in samples])
+    pooled = np.concatenate(samples)
+    order = np.argsort(pooled, kind='stable')
+    pooled = pooled[order]
+    labels = np.repeat(np.arange(len(insurers)), sizes)[order]
+
+    # below[i, p]: prices of insurer i among the first p pooled prices
+    below = np.zeros((len(insurers), pooled.size + 1), dtype=np.int64)
+    for idx in range(len(insurers)):
+        below[idx, 1:] = np.cumsum(labels == idx)
+
+    price_weight = price_weights(prices_by_insurer, weights)
+
+    rng = np.random.default_rng(seed)
+    levels = int(np.ceil(np.log2(max(pooled.size, 2)))) + 1
+    chunk = max(1, max_elements // (4 * len(insurers)))
+    columns = np.arange(len(insurers))
+
+    medians = np.empty((n_resamples, len(insurers)))
+    market = np.empty(n_resamples)
+    for start in range(0, n_resamples, chunk):
+        count = min(chunk, n_resamples - start)
+
+        market_lo = np.zeros(count, dtype=np.int64)
+        market_hi = np.full(count, pooled.size, dtype=np.int64)
+        market_counts = np.tile(sizes, (count, 1))
+        market_rank = np.full(count, (sizes * price_weight).sum() / 2)
+
+        lo = np.zeros((count, len(insurers)), dtype=np.int64)
+        hi = np.full((count, len(insurers)), pooled.size, dtype=np.int64)
+        counts = np.tile(sizes, (count, 1))
+        rank = np.tile((sizes + 1) // 2, (count, 1))
+
+        for _ in range(levels):
+            market_mid, market_lower = _split(
+                rng, market_counts, market_lo[:, None], market_hi[:, None],
+                below, columns)
+            mid, lower = _split(rng, counts, lo, hi, below, columns)
+            shared = ((lo == market_lo[:, None]) &
+                      (hi == market_hi[:, None]))
+            lower = np.where(shared, market_lower, lower)
+
+            market_mid = market_mid[:, 0]
+            total = market_lower @ price_weight
+            left = market_rank <= total
+            market_hi = np.where(left, market_mid, market_hi)
+            market_lo = np.where(left, market_lo, market_mid)
+            market_counts = np.where(left[:, None], market_lower,
+                                     market_counts - market_lower)
+            market_rank = np.where(left, market_rank, market_rank - total)
+
+            left = rank <= lower
+            hi = np.where(left, mid, hi)
+            lo = np.where(left, lo, mid)
+            counts = np.where(left, lower, counts - lower)
+            rank = np.where(left, rank, rank - lower)
+
+        market[start:start + count] = pooled[market_lo]
+        medians[start:start + count] = pooled[lo]
+    return medians, market
+
+
+def bucket_intervals(prices_by_insurer, medians, market, confidence=0.95,
+                     weights=None):
+    insurers = sorted(prices_by_insurer)
+    samples = [np.asarray(prices_by_insurer[insurer], dtype=float)
+               for insurer in insurers]
+    alpha = (1 - confidence) / 2
+    median_low, median_high = np.quantile(medians, [alpha, 1 - alpha],
+                                          axis=0)
+    diff_low, diff_high = np.quantile(medians - market[:, None],
+                                      [alpha, 1 - alpha], axis=0)
+    if weights is None:
+        market_median = np.median(np.concatenate(samples))
+    else:
+        market_median = weighted_median(
+            np.concatenate(samples),
+            np.repeat(price_weights(prices_by_insurer, weights),
+                      [sample.size for sample in samples]))
+
+    intervals = {}
+    for idx, insurer in enumerate(insurers):
+        median = np.median(samples[idx])
+        intervals[insurer] = {
+            'count': int(samples[idx].size),
+            'median': float(median),
+            'medianLow': float(median_low[idx]),
+            'medianHigh': float(median_high[idx]),
+            'marketMedian': float(market_median),
+            'diff': float(median - market_median),
+            'diffLow': float(diff_low[idx]),
+            'diffHigh': float(diff_high[idx]),
+            'significant': bool(diff_low[idx] > 0 or diff_high[idx] < 0),
+        }
+    return intervals
+
+
+def bootstrap_bucket(prices_by_insurer, n_resamples=1000, confidence=0.95,
+                     seed=None, max_elements=MAX_ELEMENTS, weights=None):
+    medians, market = resample_medians(prices_by_insurer, n_resamples, seed,
+                                       max_elements, weights)
+    return bucket_intervals(prices_by_insurer, medians, market, confidence,
+                            weights)
+
+
+def _resample_task(args):
+    return resample_medians(*args)
+
+
+def bootstrap_breakdown(grouped_prices, n_resamples=1000, confidence=0.95,
+                        seed=0, processes=1, max_elements=MAX_ELEMENTS,
+                        weights=None):
+    # The replicates of every bucket are split into one slice per process,
+    # each with its own seed, so a breakdown made of a single large bucket
+    # is spread over the pool as well as one made of many small buckets.
+    # weights optionally holds the stratum size of every bucket and insurer.
+    weights = weights or {}
+    slices = max(1, processes)
+    buckets = list(grouped_prices)
+    bucket_seeds = np.random.SeedSequence(seed).spawn(len(buckets))
+
+    owners = []
+    tasks = []
+    for bucket, bucket_seed in zip(buckets, bucket_seeds):
+        sizes = np.diff(np.linspace(0, n_resamples, slices + 1).astype(int))
+        for size, slice_seed in zip(sizes, bucket_seed.spawn(slices)):
+            if size:
+                owners.append(bucket)
+                tasks.append((grouped_prices[bucket], int(size), slice_seed,
+                              max_elements, weights.get(bucket)))
+
+    if processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_resample_task, tasks))
+    else:
+        results = [_resample_task(task) for task in tasks]
+
+    replicates = {bucket: ([], []) for bucket in buckets}
+    for bucket, (medians, market) in zip(owners, results):
+        replicates[bucket][0].append(medians)
+        replicates[bucket][1].append(market)
+
+    return {bucket: bucket_intervals(grouped_prices[bucket],
+                                     np.concatenate(replicates[bucket][0]),
+                                     np.concatenate(replicates[bucket][1]),
+                                     confidence, weights.get(bucket))
+            for bucket in buckets}
+
+
+def significance_shades(intervals):
+    # Colormap positions for every bucket and insurer: 0.5 (white) when the
+    # difference from the market median is not significant, otherwise shaded
+    # by the confidence bound closest to zero relative to the largest one in
+    # the breakdown.
+    bounds = {}
+    for bucket, by_insurer in intervals.items():
+        for insurer, interval in by_insurer.items():
+            if interval['diffLow'] > 0:
+                bounds[bucket, insurer] = interval['diffLow']
+            elif interval['diffHigh'] < 0:
+                bounds[bucket, insurer] = interval['diffHigh']
+            else:
+                bounds[bucket, insurer] = 0.0
+
+    scale = max([abs(bound) for bound in bounds.values()] + [0.0])
+    shades = {bucket: {} for bucket in intervals}
+    for (bucket, insurer), bound in bounds.items():
+        shades[bucket][insurer] = 0.5 + (0.5 * bound / scale if scale else 0)
+    return shades
+
+
+def export_intervals(intervals, file_path):
+    fields = ['bucket', 'insurer', 'count', 'median', 'medianLow',
+              'medianHigh', 'marketMedian', 'diff', 'diffLow', 'diffHigh',
+              'significant']
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        for bucket, by_insurer in intervals.items():
+            for insurer, interval in by_insurer.items():
+                writer.writerow({'bucket': bucket, 'insurer': insurer,
+                                 **interval})
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# Bump when the way cached summaries are computed changes
+CACHE_VERSION = 2
+
+
+def _digest(value):
+    payload = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def collection_fingerprint(collection):
+    # Metadata only: collection stats and the newest _id are answered from
+    # the catalog and the _id index without scanning any quotes. Inserts and
+    # deletes change it, in place updates that keep the document size (a
+    # corrected totalAmount) do not.
+    stats = collection.database.command('collStats', collection.name)
+    latest = collection.find_one(sort=[('_id', -1)], projection={'_id': 1})
+    return _digest({
+        'count': stats['count'],
+        'size': stats['size'],
+        'maxId': latest['_id'] if latest else None,
+    })
+
+
+def breakdown_fingerprint(breakdown, collection_key, params):
+    return _digest({
+        'version': CACHE_VERSION,
+        'collection': collection_key,
+        'pipeline': breakdown['pipeline'](),
+        'group': breakdown['group'].__name__,
+        'plot': {key: breakdown.get(key) for key in
+                 ('title', 'file_name', 'figsize', 'rotation')},
+        'params': params,
+    })
+
+
+def summary_path(folder_path, breakdown):
+    return os.path.join(folder_path, f"{breakdown['name']}_summary.json")
+
+
+def is_cached(folder_path, breakdown, fingerprint, outputs):
+    file_path = summary_path(folder_path, breakdown)
+    if not os.path.exists(file_path):
+        return False
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    with open(file_path) as file:
+        try:
+            return json.load(file).get('fingerprint') == fingerprint
+        except ValueError:
+            return False
+
+
+def summarize(grouped_prices, intervals):
+    summary = {}
+    for bucket, prices_by_insurer in grouped_prices.items():
+        summary[bucket] = {}
+        for insurer, prices in prices_by_insurer.items():
+            prices = np.asarray(prices, dtype=float)
+            percentile25, median, percentile75 = np.percentile(
+                prices, [25, 50, 75])
+            summary[bucket][insurer] = {
+                'count': int(prices.size),
+                'avg': float(prices.mean()),
+                'minPrice': float(prices.min()),
+                'percentile25': float(percentile25),
+                'median': float(median),
+                'percentile75': float(percentile75),
+                'maxPrice': float(prices.max()),
+                **intervals[bucket][insurer],
+            }
+    return summary
+
+
+def store_summary(folder_path, breakdown, fingerprint, summary):
+    with open(summary_path(folder_path, breakdown), 'w') as file:
+        json.dump({'fingerprint': fingerprint, 'breakdown': breakdown['name'],
+                   'buckets': summary}, file, indent=1)
@@ -4,6 +4,34 @@ import datetime
 from utils import generate_birthdate, calculate_age, save_to_mongodb
 
 
+INSURERS = [f'insurer{i}' for i in range(10)]
+VEHICLE_MODELS = [
+    'TOYOTA, COROLLA, 1.4 D-4D',
+    'HONDA, CIVIC, 1.8 i-VTEC',
+    'BMW, 3 Series, 320d',
+    'VOLKSWAGEN, PASSAT, 2.0 TDI',
+    'FORD, FOCUS, 1.6 TDCi',
+    'AUDI, A4, 2.0 TDI',
+    'MERCEDES-BENZ, E-Class, E220d',
+    'RENAULT, CLIO, 0.9 TCE',
+    'HYUNDAI, TUCSON, 1.6 GDi',
+    'KIA, CEED, 1.0 T-GDi',
+    'NISSAN, JUKE, 1.0 DIG-T',
+    'SEAT, LEON, 1.5 TSI',
+    'SKODA, KODIAQ, 2.0 TDI',
+    'TOYOTA, RAV4, 2.0 D-4D',
+    'VOLVO, S60, 2.0 T8',
+    'PEUGEOT, 3008, 1.6 PureTech',
+    'MERCEDES-BENZ, GLC, GLC220d',
+    'BMW, 5 Series, 520d',
+    'AUDI, Q5, 2.0 TDI',
+    'VOLKSWAGEN, TIGUAN, 2.0 TDI',
+    'LAND ROVER, DISCOVERY, 2.0 SD4'
+]
+START_DATE = '1950-01-01'
+END_DATE = '2004-12-31'
+
+
 def temporal_price_bias(starting_price, created_at):
 
     start_date = datetime.date.today() - datetime.timedelta(days=4 * 365)
@@ -151,37 +179,10 @@ def generate_record(insurers, vehicle_models, start_date, end_date):
 
 
 def generate_dataset(num_records):
-    insurers = [f'insurer{i}' for i in range(10)]
-    vehicle_models = [
-        'TOYOTA, COROLLA, 1.4 D-4D',
-        'HONDA, CIVIC, 1.8 i-VTEC',
-        'BMW, 3 Series, 320d',
-        'VOLKSWAGEN, PASSAT, 2.0 TDI',
-        'FORD, FOCUS, 1.6 TDCi',
-        'AUDI, A4, 2.0 TDI',
-        'MERCEDES-BENZ, E-Class, E220d',
-        'RENAULT, CLIO, 0.9 TCE',
-        'HYUNDAI, TUCSON, 1.6 GDi',
-        'KIA, CEED, 1.0 T-GDi',
-        'NISSAN, JUKE, 1.0 DIG-T',
-        'SEAT, LEON, 1.5 TSI',
-        'SKODA, KODIAQ, 2.0 TDI',
-        'TOYOTA, RAV4, 2.0 D-4D',
-        'VOLVO, S60, 2.0 T8',
-        'PEUGEOT, 3008, 1.6 PureTech',
-        'MERCEDES-BENZ, GLC, GLC220d',
-        'BMW, 5 Series, 520d',
-        'AUDI, Q5, 2.0 TDI',
-        'VOLKSWAGEN, TIGUAN, 2.0 TDI',
-        'LAND ROVER, DISCOVERY, 2.0 SD4'
-    ]
-
-    start_date = '1950-01-01'
-    end_date = '2004-12-31'
-
     dataset = []
     for _ in range(num_records):
-        record = generate_record(insurers, vehicle_models, start_date, end_date)
+        record = generate_record(INSURERS, VEHICLE_MODELS, START_DATE,
+                                 END_DATE)
         dataset.append(record)
 
     return dataset
@@ -0,0 +1,231 @@
+import argparse
+import time
+from collections import defaultdict
+
+from bson import SON, Timestamp
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+
+from utils import quote_dimensions
+
+
+STATS_COLLECTION = 'insurance_stats'
+STATE_COLLECTION = 'insurance_stats_state'
+STATE_ID = 'live_rollup'
+# Prices are accumulated into fixed width bins so that readers of the stats
+# collection can derive quartiles without every single price being kept.
+HISTOGRAM_BIN_WIDTH = 5
+SNAPSHOT_TOO_OLD = 239
+
+
+def new_aggregate():
+    return {
+        'count': 0,
+        'sum': 0.0,
+        'sumSquares': 0.0,
+        'minPrice': float('inf'),
+        'maxPrice': float('-inf'),
+        'histogram': defaultdict(int),
+    }
+
+
+class LiveRollup:
+
+    def __init__(self, client, db_name='insurance_db'):
+        self.client = client
+        self.db = client[db_name]
+        self.collection = self.db['insurance_collection']
+        self.stats = self.db[STATS_COLLECTION]
+        self.state = self.db[STATE_COLLECTION]
+        self.pending = defaultdict(new_aggregate)
+        self.resume_token = None
+        self.start_at = None
+
+    def apply(self, record):
+        buckets = quote_dimensions(record)
+        buckets['all'] = 'all'
+        for price in record.get('prices', []):
+            amount = price['totalAmount']
+            for dimension, bucket in buckets.items():
+                if bucket is None:
+                    continue
+                aggregate = self.pending[(price['brandCode'], dimension,
+                                          bucket)]
+                aggregate['count'] += 1
+                aggregate['sum'] += amount
+                aggregate['sumSquares'] += amount * amount
+                aggregate['minPrice'] = min(aggregate['minPrice'], amount)
+                aggregate['maxPrice'] = max(aggregate['maxPrice'], amount)
+                aggregate['histogram'][
+                    str(int(amount // HISTOGRAM_BIN_WIDTH))] += 1
+
+    def _updates(self):
+        updates = []
+        for (insurer, dimension, bucket), aggregate in self.pending.items():
+            increments = {
+                'count': aggregate['count'],
+                'sum': aggregate['sum'],
+                'sumSquares': aggregate['sumSquares'],
+            }
+            for bin_index, count in aggregate['histogram'].items():
+                increments[f'histogram.{bin_index}'] = count
+            updates.append(UpdateOne(
+                {'_id': {'insurer': insurer, 'dimension': dimension,
+                         'bucket': bucket}},
+                {
+                    '$inc': increments,
+                    '$min': {'minPrice': aggregate['minPrice']},
+                    '$max': {'maxPrice': aggregate['maxPrice']},
+                    '$set': {'insurer': insurer, 'dimension': dimension,
+                             'bucket': bucket},
+                    '$currentDate': {'updatedAt': True},
+                },
+                upsert=True))
+        return updates
+
+    def flush(self):
+        if not self.pending and self.resume_token is None \
+                and self.start_at is None:
+            return
+
+        updates = self._updates()
+
+        # Aggregates and resume position are written in one transaction so a
+        # restart never double counts or misses a quote.
+        def write(session):
+            if updates:
+                self.stats.bulk_write(updates, ordered=False,
+                                      session=session)
+            self.state.update_one(
+                {'_id': STATE_ID},
+                {'$set': {'resumeToken': self.resume_token,
+                          'startAtOperationTime': self.start_at}},
+                upsert=True, session=session)
+
+        with self.client.start_session() as session:
+            session.with_transaction(write)
+        self.pending.clear()
+
+    def cluster_time(self):
+        # Majority committed time, so snapshot reads at it are allowed
+        response = self.db.command(SON([
+            ('find', self.collection.name),
+            ('filter', {}),
+            ('limit', 1),
+            ('readConcern', {'level': 'majority'}),
+        ]))
+        return response['operationTime']
+
+    def backfill(self, cluster_time, batch_size=1000):
+        # Quotes committed up to cluster_time are read from a snapshot at
+        # exactly that time, the change stream starts right after it. Pages
+        # are independent snapshot reads at the same time, keyed by _id, so
+        # the whole backfill has to finish within the server's snapshot
+        # history window (minSnapshotHistoryWindowInSeconds, 300 s default).
+        last_id = None
+        while True:
+            query = {} if last_id is None else {'_id': {'$gt': last_id}}
+            try:
+                response = self.db.command(SON([
+                    ('find', self.collection.name),
+                    ('filter', query),
+                    ('sort', {'_id': 1}),
+                    ('limit', batch_size),
+                    ('batchSize', batch_size),
+                    ('singleBatch', True),
+                    ('readConcern', {'level': 'snapshot',
+                                     'atClusterTime': cluster_time}),
+                ]))
+            except OperationFailure as error:
+                if error.code == SNAPSHOT_TOO_OLD:
+                    raise RuntimeError(
+                        'Backfill outlived the snapshot history window, '
+                        'raise minSnapshotHistoryWindowInSeconds on the '
+                        'server and start again. Nothing was stored.'
+                    ) from error
+                raise
+            batch = response['cursor']['firstBatch']
+            if not batch:
+                return
+            for record in batch:
+                self.apply(record)
+            last_id = batch[-1]['_id']
+
+    def run(self, flush_interval=5.0, backfill=False, reset=False):
+        if reset:
+            self.stats.delete_many({})
+            self.state.delete_many({'_id': STATE_ID})
+
+        state = self.state.find_one({'_id': STATE_ID}) or {}
+        self.resume_token = state.get('resumeToken')
+        self.start_at = state.get('startAtOperationTime')
+
+        first_start = self.resume_token is None and self.start_at is None
+        if self.resume_token is not None:
+            position = {'resume_after': self.resume_token}
+        elif not first_start:
+            position = {'start_at_operation_time': self.start_at}
+        else:
+            cluster_time = self.cluster_time()
+            position = {'start_at_operation_time': Timestamp(
+                cluster_time.time, cluster_time.inc + 1)}
+
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        with self.collection.watch(pipeline, max_await_time_ms=1000,
+                                   **position) as stream:
+            if first_start:
+                if backfill:
+                    self.backfill(cluster_time)
+                # The start time is only stored once the backfill is
+                # complete, an interrupted first start begins from scratch
+                self.start_at = position['start_at_operation_time']
+                self.flush()
+
+            last_flush = time.monotonic()
+            # Flushes only happen here, between fully applied changes, so the
+            # stored aggregates always match the stored resume token
+            while stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self.apply(change['fullDocument'])
+                # Also advances on empty batches (post batch resume token)
+                if stream.resume_token is not None:
+                    self.resume_token = stream.resume_token
+
+                if time.monotonic() - last_flush >= flush_interval:
+                    self.flush()
+                    last_flush = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep per insurer price rollups up to date from the '
+                    'insurance_collection change stream.')
+    parser.add_argument('--flush-interval', type=float, default=5.0,
+                        help='Seconds between flushes to the stats '
+                             'collection.')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Seed the rollups with already stored quotes '
+                             'on the first start.')
+    parser.add_argument('--reset', action='store_true',
+                        help='Drop stored rollups and resume token first.')
+    args = parser.parse_args()
+
+    # Change streams and transactions need a replica set, see
+    # docker-compose.yml
+    client = MongoClient('mongodb://localhost:27017/?replicaSet=rs0')
+    rollup = LiveRollup(client)
+    print('Watching insurance_collection for new quotes...')
+    try:
+        rollup.run(flush_interval=args.flush_interval,
+                   backfill=args.backfill, reset=args.reset)
+    except KeyboardInterrupt:
+        # Quotes applied since the last flush are not written, they are
+        # read again from the stored resume token on the next start
+        pass
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
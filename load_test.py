@@ -0,0 +1,234 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from pymongo import MongoClient, ReadPreference
+
+from analyze import BREAKDOWNS, FIGURES_PATH
+from generate_dataset import END_DATE, INSURERS, START_DATE, VEHICLE_MODELS, \
+    generate_dataset, generate_record
+
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+PERCENTILES = [50, 95, 99]
+# Seconds between latency batches sent back by the insert processes
+WORKER_REPORT_INTERVAL = 0.5
+
+
+class LatencyRecorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, kind, latency):
+        with self.lock:
+            self.pending[kind].append(latency)
+
+    def record_many(self, kind, latencies, errors=0):
+        with self.lock:
+            self.pending[kind].extend(latencies)
+            if errors:
+                self.errors[kind] += errors
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] += 1
+
+    def collect(self, results):
+        # Batches sent by the insert processes
+        while True:
+            try:
+                kind, latencies, errors = results.get_nowait()
+            except queue.Empty:
+                return
+            self.record_many(kind, latencies, errors)
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+            errors, self.errors = self.errors, defaultdict(int)
+        return pending, errors
+
+
+def insert_worker(uri, db_name, rate, stop, results):
+    # Runs in its own process, so generating quotes does not compete with
+    # the query threads for the GIL. Pacing is open loop: quotes are due at
+    # a fixed rate and latency is measured from the time a quote was due,
+    # so a backlog on a saturated server shows up in the numbers. The plain
+    # round trip of insert_one is reported as insert_service.
+    client = MongoClient(uri)
+    collection = client[db_name]['insurance_collection']
+    interval = 1 / rate
+    latencies, services, errors = [], [], 0
+    scheduled = last_report = time.perf_counter()
+    record = generate_record(INSURERS, VEHICLE_MODELS, START_DATE, END_DATE)
+    while True:
+        delay = scheduled - time.perf_counter()
+        if stop.is_set() or (delay > 0 and stop.wait(delay)):
+            break
+        start = time.perf_counter()
+        try:
+            collection.insert_one(record)
+            end = time.perf_counter()
+            latencies.append(end - scheduled)
+            services.append(end - start)
+        except Exception:
+            errors += 1
+        scheduled += interval
+        record = generate_record(INSURERS, VEHICLE_MODELS, START_DATE,
+                                 END_DATE)
+
+        if time.perf_counter() - last_report >= WORKER_REPORT_INTERVAL:
+            results.put(('insert', latencies, errors))
+            results.put(('insert_service', services, 0))
+            latencies, services, errors = [], [], 0
+            last_report = time.perf_counter()
+
+    results.put(('insert', latencies, errors))
+    results.put(('insert_service', services, 0))
+    client.close()
+
+
+def query_worker(collection, recorder, stop):
+    while not stop.is_set():
+        for breakdown in BREAKDOWNS:
+            if stop.is_set():
+                break
+            start = time.perf_counter()
+            try:
+                list(collection.aggregate(breakdown['pipeline']()))
+                recorder.record(breakdown['name'],
+                                time.perf_counter() - start)
+            except Exception:
+                recorder.error(breakdown['name'])
+
+
+def summarize_latencies(elapsed, latencies, errors):
+    rows = []
+    for kind in sorted(set(latencies) | set(errors)):
+        values = np.asarray(latencies.get(kind, []), dtype=float) * 1000
+        row = {'elapsed': round(elapsed, 1), 'kind': kind,
+               'count': int(values.size), 'errors': errors.get(kind, 0)}
+        for percentile in PERCENTILES:
+            row[f'p{percentile}'] = (round(float(np.percentile(
+                values, percentile)), 2) if values.size else None)
+        rows.append(row)
+    return rows
+
+
+def print_rows(rows, interval):
+    for row in rows:
+        percentiles = ' '.join(f"p{percentile}={row[f'p{percentile}']}ms"
+                               for percentile in PERCENTILES)
+        print(f"[{row['elapsed']:>7}s] {row['kind']:<14} "
+              f"{row['count'] / interval:>8.1f}/s  {percentiles}  "
+              f"errors={row['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Insert quotes at a steady rate while running the '
+                    'analysis breakdowns and report latency percentiles.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--db', default='insurance_load_test',
+                        help='Database to run against, kept apart from '
+                             'insurance_db by default.')
+    parser.add_argument('--seed-records', type=int, default=50000,
+                        help='Quotes inserted before the run when the '
+                             'collection is empty.')
+    parser.add_argument('--insert-rate', type=float, default=200,
+                        help='Total quote inserts per second.')
+    parser.add_argument('--insert-workers', type=int, default=4)
+    parser.add_argument('--query-workers', type=int, default=1)
+    parser.add_argument('--read-preference', default='primary',
+                        choices=sorted(READ_PREFERENCES))
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Length of the run in seconds.')
+    parser.add_argument('--report-interval', type=float, default=5,
+                        help='Seconds between latency reports.')
+    args = parser.parse_args()
+    if args.insert_workers < 1:
+        parser.error('--insert-workers must be at least 1')
+    if args.insert_rate <= 0:
+        parser.error('--insert-rate must be positive')
+    if args.report_interval <= 0:
+        parser.error('--report-interval must be positive')
+
+    client = MongoClient(args.uri)
+    collection = client[args.db]['insurance_collection']
+    if args.seed_records and collection.estimated_document_count() == 0:
+        print(f'Seeding {args.seed_records} quotes...')
+        collection.insert_many(generate_dataset(args.seed_records))
+    read_collection = collection.with_options(
+        read_preference=READ_PREFERENCES[args.read_preference])
+
+    recorder = LatencyRecorder()
+    results = multiprocessing.Queue()
+    stop_inserts = multiprocessing.Event()
+    stop_queries = threading.Event()
+    inserters = [multiprocessing.Process(
+        target=insert_worker,
+        args=(args.uri, args.db, args.insert_rate / args.insert_workers,
+              stop_inserts, results))
+        for _ in range(args.insert_workers)]
+    queriers = [threading.Thread(target=query_worker,
+                                 args=(read_collection, recorder,
+                                       stop_queries))
+                for _ in range(args.query_workers)]
+    for worker in inserters + queriers:
+        worker.start()
+
+    rows = []
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() - start < args.duration:
+            time.sleep(args.report_interval)
+            recorder.collect(results)
+            interval_rows = summarize_latencies(
+                time.perf_counter() - start, *recorder.drain())
+            print_rows(interval_rows, args.report_interval)
+            rows += interval_rows
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_inserts.set()
+        stop_queries.set()
+        # The queue is drained while waiting, a process with unread results
+        # would never exit
+        for inserter in inserters:
+            while inserter.is_alive():
+                recorder.collect(results)
+                inserter.join(0.1)
+        recorder.collect(results)
+        for querier in queriers:
+            querier.join()
+        client.close()
+
+    if not os.path.exists(FIGURES_PATH):
+        os.makedirs(FIGURES_PATH)
+    file_path = os.path.join(FIGURES_PATH, 'load_test.csv')
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=[
+            'elapsed', 'kind', 'count', 'errors'] + [
+            f'p{percentile}' for percentile in PERCENTILES])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'Latencies saved to {file_path}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import csv
+from statistics import NormalDist
+
+import numpy as np
+
+
+QUANTILES = {'percentile25': 0.25, 'median': 0.5, 'percentile75': 0.75}
+# Documents drawn per bucket for every requested price, to cover insurers
+# that are missing from part of the quotes. Insurers still short of the
+# sample size get a draw of their own, unless the whole bucket was drawn.
+OVERSAMPLING = 2
+
+
+def sample_pipeline(match, sample_size, insurer=None):
+    if insurer is not None:
+        match = {**match, "prices.brandCode": insurer}
+    pipeline = [
+        {"$match": match},
+        {"$sample": {"size": sample_size}},
+        {"$unwind": "$prices"},
+    ]
+    if insurer is not None:
+        pipeline.append({"$match": {"prices.brandCode": insurer}})
+    pipeline.append({
+        "$group": {
+            "_id": "$prices.brandCode",
+            "prices": {"$push": "$prices.totalAmount"},
+        }
+    })
+    return pipeline
+
+
+def sample_breakdown(collection, strata, sample_size):
+    # Stratified sample of at most sample_size prices per insurer and
+    # bucket: every bucket is drawn on its own with $match and $sample, and
+    # every (insurer, bucket) stratum left short is drawn again restricted
+    # to that insurer's quotes, which yields min(sample_size, stratum size).
+    #
+    # Capping every insurer at sample_size gives them equal weight, so the
+    # stratum sizes are returned as well for the market median: the prices
+    # per insurer in the uncapped bucket draw, a uniform sample of the
+    # bucket's quotes and the exact sizes when the bucket was drawn whole.
+    # Insurers found only by their own draw are too rare to be weighed.
+    bucket_size = sample_size * OVERSAMPLING
+    grouped_prices = {}
+    stratum_sizes = {}
+    for bucket, match in strata:
+        results = collection.aggregate(sample_pipeline(match, bucket_size))
+        grouped_prices[bucket] = {result['_id']: result['prices']
+                                  for result in results}
+        stratum_sizes[bucket] = {insurer: len(prices) for insurer, prices
+                                 in grouped_prices[bucket].items()}
+
+    insurers = set()
+    for prices_by_insurer in grouped_prices.values():
+        insurers.update(prices_by_insurer)
+
+    for bucket, match in strata:
+        prices_by_insurer = grouped_prices[bucket]
+        short = [insurer for insurer in sorted(insurers)
+                 if len(prices_by_insurer.get(insurer, [])) < sample_size]
+        # A short bucket draw already holds every quote of the bucket
+        if not short or collection.count_documents(
+                match, limit=bucket_size + 1) <= bucket_size:
+            continue
+        for insurer in short:
+            for result in collection.aggregate(
+                    sample_pipeline(match, sample_size, insurer)):
+                prices_by_insurer[insurer] = result['prices']
+
+    grouped_prices = {
+        bucket: {insurer: prices[:sample_size]
+                 for insurer, prices in sorted(prices_by_insurer.items())}
+        for bucket, prices_by_insurer in grouped_prices.items()
+        if prices_by_insurer}
+    return grouped_prices, {
+        bucket: {insurer: stratum_sizes[bucket].get(insurer, 0)
+                 for insurer in prices_by_insurer}
+        for bucket, prices_by_insurer in grouped_prices.items()}
+
+
+def quantile_bounds(prices, q, confidence=0.95):
+    # Distribution free interval between two order statistics, using the
+    # normal approximation of the binomial distribution of their ranks
+    prices = np.sort(np.asarray(prices, dtype=float))
+    n = prices.size
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    spread = z * np.sqrt(n * q * (1 - q))
+    low = int(np.clip(np.floor(n * q - spread), 0, n - 1))
+    high = int(np.clip(np.ceil(n * q + spread), 0, n - 1))
+    return float(np.quantile(prices, q)), float(prices[low]), \
+        float(prices[high])
+
+
+def preview_bounds(grouped_prices, confidence=0.95):
+    bounds = {}
+    for bucket, prices_by_insurer in grouped_prices.items():
+        bounds[bucket] = {}
+        for insurer, prices in prices_by_insurer.items():
+            insurer_bounds = {'count': len(prices)}
+            for name, q in QUANTILES.items():
+                value, low, high = quantile_bounds(prices, q, confidence)
+                insurer_bounds[name] = value
+                insurer_bounds[f'{name}Low'] = low
+                insurer_bounds[f'{name}High'] = high
+            bounds[bucket][insurer] = insurer_bounds
+    return bounds
+
+
+def export_preview(bounds, file_path):
+    fields = ['bucket', 'insurer', 'count']
+    for name in QUANTILES:
+        fields += [name, f'{name}Low', f'{name}High']
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        for bucket, by_insurer in bounds.items():
+            for insurer, insurer_bounds in by_insurer.items():
+                writer.writerow({'bucket': bucket, 'insurer': insurer,
+                                 **insurer_bounds})
@@ -0,0 +1,346 @@
+import argparse
+import csv
+import os
+from datetime import date, timedelta
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+from pymongo import ASCENDING, MongoClient
+
+from analyze import FIGURES_PATH
+
+
+matplotlib.use('agg')
+# Daily prices are kept as fixed width histograms, so rolling windows are
+# differences of cumulative histograms and cost the same for any window size.
+BIN_WIDTH = 5
+NUM_BINS = 400
+STATE_FILE = os.path.join(FIGURES_PATH, 'trends_state.npz')
+
+
+def daily_prices_pipeline(since=None):
+    pipeline = []
+    if since is not None:
+        pipeline.append({"$match": {"createdAt": {"$gte": since}}})
+    pipeline += [
+        {
+            "$unwind": "$prices"
+        },
+        {
+            "$group": {
+                "_id": {
+                    "insurer": "$prices.brandCode",
+                    "day": {"$substrBytes": ["$createdAt", 0, 10]}
+                },
+                "prices": {"$push": "$prices.totalAmount"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "insurer": "$_id.insurer",
+                "day": "$_id.day",
+                "prices": 1,
+            }
+        },
+    ]
+    return pipeline
+
+
+def daily_quotes_pipeline(since=None):
+    pipeline = []
+    if since is not None:
+        pipeline.append({"$match": {"createdAt": {"$gte": since}}})
+    pipeline.append({
+        "$group": {
+            "_id": {"$substrBytes": ["$createdAt", 0, 10]},
+            "count": {"$sum": 1},
+        }
+    })
+    return pipeline
+
+
+def histogram_quantile(hist, q):
+    # Linear interpolation inside the bin holding the quantile, so a smooth
+    # drift moves the estimate smoothly instead of in whole bin steps
+    counts = hist.cumsum(axis=-1)
+    total = counts[..., -1]
+    target = q * total
+    idx = (counts >= target[..., None]).argmax(axis=-1)
+    in_bin = np.take_along_axis(hist, idx[..., None], axis=-1)[..., 0]
+    before = np.take_along_axis(counts, idx[..., None], axis=-1)[..., 0] - \
+        in_bin
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(in_bin > 0, (target - before) / in_bin, 0.5)
+    return np.where(total > 0, (idx + fraction) * BIN_WIDTH, np.nan)
+
+
+def median_standard_error(hist):
+    # Normal approximation, with the spread estimated from the IQR
+    total = hist.sum(axis=-1)
+    sigma = (histogram_quantile(hist, 0.75) -
+             histogram_quantile(hist, 0.25)) / 1.349
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1.2533 * np.maximum(sigma, BIN_WIDTH) / np.sqrt(total)
+
+
+class RollingTrends:
+
+    def __init__(self, window=30):
+        self.window = window
+        self.start = None
+        # Number of quotes dated before the last tracked day, used to notice
+        # quotes added to days that incremental runs no longer fetch
+        self.covered = 0
+        self.insurers = []
+        # cum[i, d] is the histogram of all prices of insurer i before day d
+        self.cum = np.zeros((0, 1, NUM_BINS), dtype=np.int32)
+        self.medians = np.zeros((0, 0))
+        self.volumes = np.zeros((0, 0), dtype=np.int64)
+        self.shifts = np.zeros((0, 0))
+        self.scores = np.zeros((0, 0))
+
+    @property
+    def num_days(self):
+        return self.cum.shape[1] - 1
+
+    def day(self, idx):
+        return self.start + timedelta(days=int(idx))
+
+    def _extend(self, insurers, num_days):
+        new_insurers = sorted(set(insurers) - set(self.insurers))
+        if new_insurers:
+            self.insurers += new_insurers
+            pad = ((0, len(new_insurers)), (0, 0))
+            self.cum = np.pad(self.cum, pad + ((0, 0),))
+            self.medians = np.pad(self.medians, pad,
+                                  constant_values=np.nan)
+            self.volumes = np.pad(self.volumes, pad)
+            self.shifts = np.pad(self.shifts, pad, constant_values=np.nan)
+            self.scores = np.pad(self.scores, pad, constant_values=np.nan)
+
+        extra = num_days - self.num_days
+        if extra > 0:
+            self.cum = np.concatenate(
+                [self.cum, np.repeat(self.cum[:, -1:], extra, axis=1)],
+                axis=1)
+            pad = ((0, 0), (0, extra))
+            self.medians = np.pad(self.medians, pad,
+                                  constant_values=np.nan)
+            self.volumes = np.pad(self.volumes, pad)
+            self.shifts = np.pad(self.shifts, pad, constant_values=np.nan)
+            self.scores = np.pad(self.scores, pad, constant_values=np.nan)
+
+    def update(self, results):
+        # Replaces every day from the earliest day in results onwards and
+        # recomputes only the windows touching those days.
+        if not results:
+            return
+        days = [date.fromisoformat(result['day']) for result in results]
+        if self.start is None:
+            self.start = min(days)
+        if min(days) < self.start:
+            raise ValueError('Quotes older than the tracked history, '
+                             'rebuild the trends instead.')
+
+        first = (min(days) - self.start).days
+        last = (max(days) - self.start).days
+        self._extend([result['insurer'] for result in results],
+                     max(last + 1, self.num_days))
+
+        daily = np.zeros((len(self.insurers), self.num_days - first,
+                          NUM_BINS), dtype=np.int32)
+        insurer_index = {insurer: idx
+                         for idx, insurer in enumerate(self.insurers)}
+        for result, day in zip(results, days):
+            bins = np.clip(np.asarray(result['prices']) // BIN_WIDTH, 0,
+                           NUM_BINS - 1)
+            daily[insurer_index[result['insurer']],
+                  (day - self.start).days - first] += np.bincount(
+                bins.astype(np.int64), minlength=NUM_BINS).astype(np.int32)
+
+        self.cum[:, first + 1:] = (self.cum[:, first:first + 1] +
+                                   daily.cumsum(axis=1, dtype=np.int32))
+        self.refresh(first)
+
+    def refresh(self, first=0):
+        window = self.window
+        num_days = self.num_days
+
+        # Trailing windows ending on days first..num_days - 1
+        ends = np.arange(first, num_days)
+        hist = (self.cum[:, ends + 1] -
+                self.cum[:, np.maximum(ends + 1 - window, 0)])
+        self.medians[:, first:] = histogram_quantile(hist, 0.5)
+        self.volumes[:, first:] = hist.sum(axis=-1)
+
+        # Level shift between the windows right before and after a day
+        splits = np.arange(max(window, first - window + 1),
+                           num_days - window + 1)
+        if splits.size:
+            before = self.cum[:, splits] - self.cum[:, splits - window]
+            after = self.cum[:, splits + window] - self.cum[:, splits]
+            shift = (histogram_quantile(after, 0.5) -
+                     histogram_quantile(before, 0.5))
+            error = np.hypot(median_standard_error(before),
+                             median_standard_error(after))
+            self.shifts[:, splits] = shift
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.scores[:, splits] = shift / error
+
+    def change_points(self, threshold=4.0):
+        # Days whose shift score passes the threshold and is the largest
+        # within half a window on either side
+        scores = np.nan_to_num(np.abs(self.scores), nan=0.0)
+        radius = max(1, self.window // 2)
+        padded = np.pad(scores, ((0, 0), (radius, radius)))
+        neighbourhood = np.lib.stride_tricks.sliding_window_view(
+            padded, 2 * radius + 1, axis=1).max(axis=-1)
+        flagged = (scores >= threshold) & (scores >= neighbourhood)
+
+        change_points = []
+        for insurer_idx, day_idx in zip(*np.nonzero(flagged)):
+            change_points.append({
+                'day': self.day(day_idx).isoformat(),
+                'insurer': self.insurers[insurer_idx],
+                'shift': float(self.shifts[insurer_idx, day_idx]),
+                'score': float(self.scores[insurer_idx, day_idx]),
+            })
+        change_points.sort(key=lambda x: (x['day'], x['insurer']))
+        return change_points
+
+    def save(self, file_path):
+        np.savez_compressed(file_path, window=self.window,
+                            start=self.start.toordinal(),
+                            covered=self.covered,
+                            insurers=np.array(self.insurers), cum=self.cum,
+                            medians=self.medians, volumes=self.volumes,
+                            shifts=self.shifts, scores=self.scores)
+
+    @classmethod
+    def load(cls, file_path, window):
+        state = np.load(file_path)
+        trends = cls(window)
+        trends.start = date.fromordinal(int(state['start']))
+        trends.covered = int(state['covered'])
+        trends.insurers = list(state['insurers'])
+        trends.cum = state['cum']
+        trends.medians = state['medians']
+        trends.volumes = state['volumes']
+        trends.shifts = state['shifts']
+        trends.scores = state['scores']
+        if int(state['window']) != window:
+            # Splits that are not valid for the new window must not keep
+            # scores computed with the old one
+            trends.shifts[:] = np.nan
+            trends.scores[:] = np.nan
+            trends.refresh()
+        return trends
+
+
+def export_trends(trends, change_points):
+    with open(os.path.join(FIGURES_PATH, 'trends_rolling.csv'), 'w',
+              newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['day', 'insurer', 'rollingMedian', 'volume'])
+        for day_idx in range(trends.num_days):
+            day = trends.day(day_idx).isoformat()
+            for insurer_idx, insurer in enumerate(trends.insurers):
+                writer.writerow([day, insurer,
+                                 trends.medians[insurer_idx, day_idx],
+                                 trends.volumes[insurer_idx, day_idx]])
+
+    with open(os.path.join(FIGURES_PATH, 'trends_change_points.csv'), 'w',
+              newline='') as file:
+        writer = csv.DictWriter(file,
+                                fieldnames=['day', 'insurer', 'shift',
+                                            'score'])
+        writer.writeheader()
+        writer.writerows(change_points)
+
+
+def plot_trends(trends, change_points):
+    days = np.datetime64(trends.start) + np.arange(trends.num_days)
+    fig, axes = plt.subplots(nrows=len(trends.insurers), ncols=1,
+                             figsize=(15, 3 * len(trends.insurers)),
+                             sharex=True, squeeze=False)
+
+    for idx, (ax, insurer) in enumerate(zip(axes[:, 0], trends.insurers)):
+        ax.plot(days, trends.medians[idx])
+        for change_point in change_points:
+            if change_point['insurer'] == insurer:
+                ax.axvline(np.datetime64(change_point['day']),
+                           color='green' if change_point['shift'] < 0
+                           else 'red', linestyle='--')
+        ax.set_ylabel('Price')
+        ax.set_title(f'Rolling {trends.window} day median price - '
+                     f'{insurer}')
+
+    fig.tight_layout()
+    file_path = os.path.join(FIGURES_PATH,
+                             'insurance_prices_trend_insurer.png')
+    plt.savefig(file_path)
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rolling price trends and price shifts per insurer.')
+    parser.add_argument('--window', type=int, default=30,
+                        help='Rolling window length in days.')
+    parser.add_argument('--threshold', type=float, default=4.0,
+                        help='Shift score needed to flag a change point.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Ignore the stored state and scan all quotes.')
+    args = parser.parse_args()
+
+    client = MongoClient("mongodb://localhost:27017")
+    db = client["insurance_db"]
+    collection = db["insurance_collection"]
+    collection.create_index([("createdAt", ASCENDING)])
+
+    if not os.path.exists(FIGURES_PATH):
+        os.makedirs(FIGURES_PATH)
+
+    trends = None
+    if os.path.exists(STATE_FILE) and not args.rebuild:
+        trends = RollingTrends.load(STATE_FILE, args.window)
+        # The last tracked day may have been partial, so it is fetched again
+        since = trends.day(trends.num_days - 1).isoformat()
+        covered = collection.count_documents({"createdAt": {"$lt": since}})
+        if covered != trends.covered:
+            print('Quotes were added to or removed from already tracked '
+                  'days, rebuilding the trends.')
+            trends = None
+    if trends is None:
+        trends = RollingTrends(args.window)
+        since = None
+        covered = 0
+
+    # Quotes per day are counted before the prices are fetched, so a quote
+    # inserted in between can only make the next check fail, never be lost
+    day_counts = {result['_id']: result['count']
+                  for result in collection.aggregate(
+                      daily_quotes_pipeline(since))}
+    results = list(collection.aggregate(daily_prices_pipeline(since)))
+    trends.update(results)
+    client.close()
+
+    if trends.start is None:
+        print('No quotes found.')
+        return
+
+    last_day = trends.day(trends.num_days - 1).isoformat()
+    trends.covered = covered + sum(count for day, count in day_counts.items()
+                                   if day < last_day)
+
+    trends.save(STATE_FILE)
+    change_points = trends.change_points(args.threshold)
+    export_trends(trends, change_points)
+    plot_trends(trends, change_points)
+    print(f'{len(change_points)} change points found.')
+
+
+if __name__ == '__main__':
+    main()
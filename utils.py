@@ -76,4 +76,47 @@ def truncate_mongodb():
     db = client['insurance_db']
     collection = db['insurance_collection']
     collection.delete_many({})
-    client.close()
\ No newline at end of file
+    client.close()
+
+
+AGE_GROUPS = {
+    '18-24': {'min': 0, 'max': 24},
+    '25-65': {'min': 25, 'max': 65},
+    '65+': {'min': 66, 'max': float('inf')}
+}
+
+CAR_AGE_GROUPS = [
+    (5, 'Below 5 years'),
+    (10, '5 to 10 years'),
+    (15, '10 to 15 years'),
+    (20, '15 to 20 years'),
+    (25, '20 to 25 years'),
+]
+
+
+def age_group(birth_date):
+    # Same year-difference age as the age breakdown in analyze.py
+    age = datetime.datetime.now().year - int(birth_date[:4])
+    for group, age_range in AGE_GROUPS.items():
+        if age_range['min'] <= age <= age_range['max']:
+            return group
+    return None
+
+
+def car_age_group(production_year):
+    car_age = datetime.datetime.now().year - int(production_year)
+    for limit, group in CAR_AGE_GROUPS:
+        if car_age < limit:
+            return group
+    return 'Above 25 years'
+
+
+def quote_dimensions(record):
+    # Bucket of a single quote for every breakdown produced by analyze.py
+    data = record["calculationData"]["data"]
+    return {
+        'age': age_group(data["owner"]["birthDate"]),
+        'carAge': car_age_group(data["vehicle"]["productionYear"]),
+        'location': data["registration"]["prefix"],
+        'month': int(record["createdAt"][5:7]),
+    }